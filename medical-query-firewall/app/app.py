@@ -1,30 +1,67 @@
 # app/app.py
 from fastapi import FastAPI, Request, HTTPException, Depends, Header
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.responses import HTMLResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
-import json
+import asyncio
+import itertools
+import orjson
+import re
+import time
 from datetime import datetime
 from collections import Counter
+from typing import Dict, List
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Local imports
-from .utils import mask_pii, decision_aggregator, pass_through_llm, RULES_PATH
-from .audit_db import init_db, insert_audit, fetch_audits, fetch_audit_by_id, set_reviewer_decision
+from .utils import (
+    mask_pii, decision_aggregator, pass_through_llm, save_rules, get_rules,
+    start_classifier_batcher, stop_classifier_batcher
+)
+from .audit_db import (
+    init_db, insert_audits_many, max_audit_id, iter_audits, fetch_warn_audits,
+    fetch_audit_by_id, set_reviewer_decision
+)
 
 # base paths
 BASE = Path(__file__).resolve().parent.parent
 
-# --- Logging setup (rotating) ---
+# --- Logging setup (rotating, async) ---
+# Handlers only enqueue records; a QueueListener thread does the actual file
+# I/O so request handlers never block on disk. The file handler buffers
+# writes (64 KB) instead of flushing per record; a background task flushes
+# it once a second.
 LOG_DIR = BASE / "logs"
 LOG_DIR.mkdir(exist_ok=True)
-handler = RotatingFileHandler(LOG_DIR / "server.log", maxBytes=2_000_000, backupCount=3)
-logging.basicConfig(level=logging.INFO, handlers=[handler], format='%(asctime)s %(levelname)s %(message)s')
+
+class BufferedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler that skips the per-record flush; call force_flush()."""
+    def _open(self):
+        return open(self.baseFilename, self.mode, buffering=65536, encoding=self.encoding)
+
+    def flush(self):
+        pass  # buffered; flushed periodically and on close
+
+    def force_flush(self):
+        with self.lock:
+            if self.stream:
+                self.stream.flush()
+
+    def close(self):
+        self.force_flush()
+        super().close()
+
+log_queue: queue.SimpleQueue = queue.SimpleQueue()
+file_handler = BufferedRotatingFileHandler(LOG_DIR / "server.log", maxBytes=2_000_000, backupCount=3)
+file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+log_listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
 logger = logging.getLogger(__name__)
 
 # --- App setup ---
-app = FastAPI(title="Medical Query Firewall (MVP)")
+app = FastAPI(title="Medical Query Firewall (MVP)", default_response_class=ORJSONResponse)
 
 # Serve static UI
 app.mount("/static", StaticFiles(directory=BASE / "static"), name="static")
@@ -39,6 +76,87 @@ METRICS = Counter()
 # Simple admin key for demo (change this before presentation)
 ADMIN_KEY = "hackathon-demo-key-CHANGE_ME"
 
+# --- Background audit writer ---
+# Audit inserts are queued and flushed in batches so a chat request never
+# blocks on an SQLite commit. Ids are handed out from an in-process counter
+# (seeded from the table at startup) so the response can report audit_id
+# before the row actually lands.
+AUDIT_BATCH_MAX = 200
+AUDIT_FLUSH_TIMEOUT = 0.05  # seconds to wait for more rows before flushing
+
+audit_queue: asyncio.Queue = asyncio.Queue()
+_audit_id_counter = itertools.count(1)  # re-seeded on startup
+
+# Shutdown pushes this sentinel instead of cancelling the writer task:
+# wait_for can swallow an external cancel when the inner get() already has a
+# row ready, which left the task stuck in "cancelling" and hung shutdown.
+_AUDIT_STOP = None
+
+async def _audit_writer():
+    stopping = False
+    while not stopping:
+        row = await audit_queue.get()
+        if row is _AUDIT_STOP:
+            return
+        batch = [row]
+        while len(batch) < AUDIT_BATCH_MAX:
+            try:
+                row = await asyncio.wait_for(audit_queue.get(), timeout=AUDIT_FLUSH_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+            if row is _AUDIT_STOP:
+                stopping = True  # flush what we pulled, then exit
+                break
+            batch.append(row)
+        try:
+            insert_audits_many(batch)
+        except Exception:
+            logger.exception("Failed to flush %d audit records", len(batch))
+
+async def _log_flusher():
+    while True:
+        await asyncio.sleep(1)
+        file_handler.force_flush()
+
+@app.on_event("startup")
+async def _start_audit_writer():
+    global _audit_id_counter
+    _audit_id_counter = itertools.count(max_audit_id() + 1)
+    app.state.audit_writer = asyncio.create_task(_audit_writer())
+    app.state.classifier_batcher = start_classifier_batcher()
+    log_listener.start()
+    app.state.log_flusher = asyncio.create_task(_log_flusher())
+
+@app.on_event("shutdown")
+async def _stop_audit_writer():
+    stop_classifier_batcher()
+    for attr in ("classifier_batcher", "log_flusher"):
+        task = getattr(app.state, attr, None)
+        if task:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    # stop the writer via the sentinel (see _AUDIT_STOP) and wait for it to
+    # flush whatever it had already pulled off the queue
+    writer = getattr(app.state, "audit_writer", None)
+    if writer:
+        audit_queue.put_nowait(_AUDIT_STOP)
+        await writer
+    # flush anything still queued
+    remaining = []
+    while not audit_queue.empty():
+        row = audit_queue.get_nowait()
+        if row is not _AUDIT_STOP:
+            remaining.append(row)
+    try:
+        insert_audits_many(remaining)
+    except Exception:
+        logger.exception("Failed to flush %d audit records on shutdown", len(remaining))
+    log_listener.stop()  # drains the queue, then force_flush via handler close path
+    file_handler.force_flush()
+
 def check_admin(x_api_key: str = Header(None)):
     if x_api_key != ADMIN_KEY:
         raise HTTPException(status_code=401, detail="Unauthorized")
@@ -66,24 +184,18 @@ async def chat_endpoint(req: Request):
     session_id = body.get("session_id", "anon")
     user_meta = body.get("meta", {})
 
-    METRICS['last_request'] = datetime.utcnow().isoformat()
+    # cheap epoch float here; formatted lazily in /metrics
+    METRICS['last_request'] = time.time()
 
     # Step 1: Preprocess & mask PII
     pii_res = mask_pii(text)
     masked = pii_res["masked_text"]
+    masked_lower = masked.lower()  # case-fold once for all downstream matching
 
     # Step 2: Decision aggregation
-    decision = decision_aggregator(masked)
+    decision = await decision_aggregator(masked, masked_lower)
 
-    # Build explainability info
-    explain = {
-        "masked_text": masked,
-        "pii_detected": pii_res["pii"],
-        "matched_rules": [ { "id": r.get("id"), "explanation": r.get("explanation"), "action": r.get("action") } for r in decision.get("matched_rules", []) ],
-        "classifier": decision.get("classifier")
-    }
-
-    # Insert audit record (persist)
+    # Insert audit record (persist; JSON-encoding happens in the writer task)
     audit_record = {
         "timestamp": datetime.utcnow().isoformat() + "Z",
         "session_id": session_id,
@@ -96,59 +208,99 @@ async def chat_endpoint(req: Request):
         "block_hits": decision.get("block_hits", []),
         "warn_hits": decision.get("warn_hits", [])
     }
+    audit_id = None
+    audit_error = None
     try:
-        audit_id = insert_audit(audit_record)
-        explain["audit_id"] = audit_id
+        audit_record["id"] = audit_id = next(_audit_id_counter)
+        audit_queue.put_nowait(audit_record)
     except Exception as e:
-        logger.exception("Failed to insert audit: %s", e)
-        explain["audit_error"] = str(e)
+        logger.exception("Failed to enqueue audit: %s", e)
+        audit_error = str(e)
+
+    # Explainability payload; skipped on the BLOCK fast path unless the
+    # caller asks for it (?debug=1) or holds the admin key.
+    debug = bool(req.query_params.get("debug")) or req.headers.get("x-api-key") == ADMIN_KEY
+
+    def build_explain():
+        explain = {
+            "masked_text": masked,
+            "pii_detected": pii_res["pii"],
+            "matched_rules": [ { "id": r.get("id"), "explanation": r.get("explanation"), "action": r.get("action") } for r in decision.get("matched_rules", []) ],
+            "classifier": decision.get("classifier")
+        }
+        if audit_id is not None:
+            explain["audit_id"] = audit_id
+        if audit_error is not None:
+            explain["audit_error"] = audit_error
+        return explain
 
     # Return responses depending on decision
     if decision["decision"] == "BLOCK":
         METRICS['blocked'] += 1
         safe_response = "Sorry, I can’t assist with that. This request appears unsafe. Please consult a licensed healthcare professional or ask for general information."
-        logger.info("BLOCK: %s (audit_id=%s)", masked, explain.get("audit_id"))
-        return JSONResponse({
+        logger.info("BLOCK: %s (audit_id=%s)", masked, audit_id)
+        resp = {
             "decision": "BLOCK",
-            "safe_response": safe_response,
-            "explain": explain
-        })
+            "safe_response": safe_response
+        }
+        if debug:
+            resp["explain"] = build_explain()
+        return ORJSONResponse(resp)
     elif decision["decision"] == "WARN":
         METRICS['warned'] += 1
-        llm_response = pass_through_llm(masked)
-        logger.info("WARN: %s (audit_id=%s)", masked, explain.get("audit_id"))
-        return JSONResponse({
+        llm_response = pass_through_llm(masked, masked_lower)
+        logger.info("WARN: %s (audit_id=%s)", masked, audit_id)
+        return ORJSONResponse({
             "decision": "WARN",
             "llm_response": llm_response,
             "warning": "This query appears risky. Please consult a professional for prescriptions/procedures.",
-            "explain": explain
+            "explain": build_explain()
         })
     else:  # ALLOW
         METRICS['allowed'] += 1
-        llm_response = pass_through_llm(masked)
-        logger.info("ALLOW: %s (audit_id=%s)", masked, explain.get("audit_id"))
-        return JSONResponse({
+        llm_response = pass_through_llm(masked, masked_lower)
+        logger.info("ALLOW: %s (audit_id=%s)", masked, audit_id)
+        return ORJSONResponse({
             "decision": "ALLOW",
             "llm_response": llm_response,
-            "explain": explain
+            "explain": build_explain()
         })
 
 # ----------------------------
 # Admin endpoints (protected)
 # ----------------------------
 
+# these columns already hold JSON text; splice them into the response raw
+# instead of decoding and re-encoding each one per row
+_AUDIT_JSON_COLS = ("pii", "classifier_json", "matched_rules", "block_hits", "warn_hits")
+
+def _audit_row_bytes(r) -> bytes:
+    # raw_text is deliberately absent: the listing is projected to the
+    # admin columns and the masked text is what reviewers look at
+    head = orjson.dumps({
+        "id": r["id"], "timestamp": r["timestamp"], "session_id": r["session_id"],
+        "masked_text": r["masked_text"],
+        "decision": r["decision"], "reviewer_decision": r["reviewer_decision"],
+    })
+    parts = [head[:-1]]  # drop closing brace, append the raw JSON columns
+    for key in _AUDIT_JSON_COLS:
+        raw = r[key]
+        parts.append(b',"' + key.encode() + b'":' + (raw.encode() if raw else b"null"))
+    parts.append(b"}")
+    return b"".join(parts)
+
 @app.get("/admin/audit", dependencies=[Depends(check_admin)])
-async def admin_get_audits(limit: int = 200):
-    rows = fetch_audits(limit=limit)
-    # parse JSON string fields for readability
-    for r in rows:
-        for key in ("pii", "classifier_json", "matched_rules", "block_hits", "warn_hits"):
-            if r.get(key):
-                try:
-                    r[key] = json.loads(r[key])
-                except Exception:
-                    pass
-    return {"count": len(rows), "audits": rows}
+async def admin_get_audits(limit: int = 200, offset: int = 0):
+    async def gen():
+        yield b'{"audits":['
+        count = 0
+        for row in iter_audits(limit=limit, offset=offset):
+            if count:
+                yield b","
+            yield _audit_row_bytes(row)
+            count += 1
+        yield b'],"count":%d}' % count
+    return StreamingResponse(gen(), media_type="application/json")
 
 @app.get("/admin/audit/{aid}", dependencies=[Depends(check_admin)])
 async def admin_get_audit(aid: int):
@@ -158,42 +310,29 @@ async def admin_get_audit(aid: int):
     for key in ("pii", "classifier_json", "matched_rules", "block_hits", "warn_hits"):
         if r.get(key):
             try:
-                r[key] = json.loads(r[key])
+                r[key] = orjson.loads(r[key])
             except Exception:
                 pass
     return r
 
 @app.get("/admin/rules", dependencies=[Depends(check_admin)])
 async def admin_get_rules():
-    with open(RULES_PATH, "r", encoding="utf-8") as f:
-        return json.load(f)
+    # in-memory rules; re-read from disk only when rules.json's mtime changes
+    return get_rules()
 
 @app.post("/admin/rules", dependencies=[Depends(check_admin)])
-async def admin_update_rules(new_rules: dict):
-    if not isinstance(new_rules, list):
-        raise HTTPException(status_code=400, detail="rules must be a list")
-    with open(RULES_PATH, "w", encoding="utf-8") as f:
-        json.dump(new_rules, f, indent=2)
-    # try to update in-memory RULES variable in utils (best-effort)
+async def admin_update_rules(new_rules: List[Dict]):
+    # validate + compile before anything is persisted; a rejected upload must
+    # not leave a ruleset on disk that the next server start can't load
     try:
-        from . import utils as _utils
-        _utils.RULES = new_rules
-    except Exception:
-        logger.warning("Could not reload RULES in-memory; server restart may be required.")
+        save_rules(new_rules)
+    except (ValueError, re.error) as e:
+        raise HTTPException(status_code=400, detail=f"invalid rules: {e}")
     return {"status": "ok", "rules_count": len(new_rules)}
 
 @app.get("/admin/review", dependencies=[Depends(check_admin)])
 async def admin_review_queue(limit: int = 200):
-    rows = fetch_audits(limit=limit)
-    warn_items = []
-    for r in rows:
-        if r.get("warn_hits"):
-            try:
-                wh = json.loads(r["warn_hits"])
-                if wh:
-                    warn_items.append(r)
-            except Exception:
-                pass
+    warn_items = fetch_warn_audits(limit=limit)
     return {"count": len(warn_items), "warn_items": warn_items}
 
 @app.post("/admin/review/{aid}", dependencies=[Depends(check_admin)])
@@ -207,10 +346,11 @@ async def admin_review_decision(aid: int, action: str):
 
 @app.get("/metrics", dependencies=[Depends(check_admin)])
 async def metrics():
+    last_request = METRICS.get('last_request')
     return {
         "requests": METRICS.get('requests', 0),
         "allowed": METRICS.get('allowed', 0),
         "blocked": METRICS.get('blocked', 0),
         "warned": METRICS.get('warned', 0),
-        "last_request": METRICS.get('last_request')
+        "last_request": datetime.utcfromtimestamp(last_request).isoformat() if last_request else None
     }
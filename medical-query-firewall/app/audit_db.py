@@ -1,18 +1,46 @@
 # app/audit_db.py
 import sqlite3
+import atexit
+import threading
 from pathlib import Path
-import json
+import orjson
 from typing import Dict, Any, List
 
 # DB file stored at project_root/data/audit.db
 DB_PATH = Path(__file__).resolve().parent.parent / "data" / "audit.db"
 DB_PATH.parent.mkdir(parents=True, exist_ok=True)
 
+# One cached connection per thread (sqlite3 connections are not thread-safe
+# to share). WAL + synchronous=NORMAL avoids the double fsync per insert
+# of the default rollback journal, which dominates /api/chat latency.
+_local = threading.local()
+_open_conns = []
+_open_conns_lock = threading.Lock()
+
 def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        _local.conn = conn
+        with _open_conns_lock:
+            _open_conns.append(conn)
     return conn
 
+@atexit.register
+def _close_conns():
+    with _open_conns_lock:
+        for conn in _open_conns:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        _open_conns.clear()
+
 def init_db():
     conn = get_conn()
     cur = conn.cursor()
@@ -32,59 +60,117 @@ def init_db():
         reviewer_decision TEXT
     )
     """)
-    conn.commit()
-    conn.close()
-
-def insert_audit(audit: Dict[str, Any]) -> int:
-    """Insert an audit record. Returns the new row id."""
-    conn = get_conn()
-    cur = conn.cursor()
+    # partial index so the review queue doesn't scan the whole table
     cur.execute("""
-    INSERT INTO audits (
-        timestamp, session_id, raw_text, masked_text, pii, decision,
-        classifier_json, matched_rules, block_hits, warn_hits, reviewer_decision
-    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (
+    CREATE INDEX IF NOT EXISTS idx_audits_warn ON audits(id DESC)
+    WHERE warn_hits IS NOT NULL AND warn_hits != '[]'
+    """)
+
+def _audit_row(audit: Dict[str, Any]) -> tuple:
+    """Map an audit dict to the bound-parameter tuple for INSERT."""
+    return (
+        audit.get("id"),
         audit.get("timestamp"),
         audit.get("session_id"),
         audit.get("raw_text"),
         audit.get("masked_text"),
-        json.dumps(audit.get("pii") or []),
+        orjson.dumps(audit.get("pii") or []).decode(),
         audit.get("decision"),
-        json.dumps(audit.get("classifier") or {}),
-        json.dumps(audit.get("matched_rules") or []),
-        json.dumps(audit.get("block_hits") or []),
-        json.dumps(audit.get("warn_hits") or []),
+        orjson.dumps(audit.get("classifier") or {}).decode(),
+        orjson.dumps(audit.get("matched_rules") or []).decode(),
+        orjson.dumps(audit.get("block_hits") or []).decode(),
+        orjson.dumps(audit.get("warn_hits") or []).decode(),
         None
-    ))
-    conn.commit()
-    rowid = cur.lastrowid
-    conn.close()
-    return rowid
+    )
+
+_INSERT_SQL = """
+    INSERT INTO audits (
+        id, timestamp, session_id, raw_text, masked_text, pii, decision,
+        classifier_json, matched_rules, block_hits, warn_hits, reviewer_decision
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """
+
+def insert_audit(audit: Dict[str, Any]) -> int:
+    """Insert an audit record. Returns the new row id."""
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(_INSERT_SQL, _audit_row(audit))
+    return cur.lastrowid
+
+def insert_audits_many(audits: List[Dict[str, Any]], chunk_size: int = 500) -> None:
+    """Bulk-insert audit records in a single transaction (one fsync total).
+
+    Rows go through executemany in chunks of `chunk_size`. This is the flush
+    primitive for the background audit writer and the right entry point for
+    training pipelines / bulk importers — never insert row-at-a-time in a loop.
+    """
+    if not audits:
+        return
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        for start in range(0, len(audits), chunk_size):
+            chunk = audits[start:start + chunk_size]
+            cur.executemany(_INSERT_SQL, [_audit_row(a) for a in chunk])
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+def max_audit_id() -> int:
+    """Highest id currently in the audits table (0 if empty)."""
+    conn = get_conn()
+    row = conn.execute("SELECT MAX(id) FROM audits").fetchone()
+    return row[0] or 0
+
+AUDIT_COLUMNS = (
+    "id", "timestamp", "session_id", "raw_text", "masked_text", "pii",
+    "decision", "classifier_json", "matched_rules", "block_hits",
+    "warn_hits", "reviewer_decision"
+)
+# what admin listings actually need — raw_text is the one big unused column
+_ADMIN_COLUMNS = tuple(c for c in AUDIT_COLUMNS if c != "raw_text")
+
+def iter_audits(limit: int = 200, offset: int = 0, columns: tuple = _ADMIN_COLUMNS):
+    """Yield audit rows newest-first, projected to `columns`.
+
+    Rows come out in fetchmany chunks (sqlite3.Row, mapping access by column
+    name) so a large page is never materialized all at once, and raw_text —
+    the one big column the admin listing doesn't show — is never read off
+    disk unless explicitly requested.
+    """
+    unknown = set(columns) - set(AUDIT_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown audit columns: {sorted(unknown)}")
+    conn = get_conn()
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT {','.join(columns)} FROM audits ORDER BY id DESC LIMIT ? OFFSET ?",
+        (limit, offset))
+    while True:
+        rows = cur.fetchmany(50)
+        if not rows:
+            break
+        yield from rows
 
-def fetch_audits(limit: int = 200) -> List[Dict[str, Any]]:
+def fetch_warn_audits(limit: int = 200) -> List[Dict[str, Any]]:
+    """Audits with non-empty warn_hits, newest first (uses the partial index)."""
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT * FROM audits ORDER BY id DESC LIMIT ?", (limit,))
-    rows = cur.fetchall()
-    conn.close()
-    result = []
-    for r in rows:
-        d = dict(r)
-        result.append(d)
-    return result
+    cur.execute(
+        "SELECT * FROM audits WHERE warn_hits IS NOT NULL AND warn_hits != '[]' "
+        "ORDER BY id DESC LIMIT ?", (limit,))
+    return [dict(r) for r in cur.fetchall()]
 
 def fetch_audit_by_id(aid: int) -> Dict[str, Any]:
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("SELECT * FROM audits WHERE id=?", (aid,))
     row = cur.fetchone()
-    conn.close()
     return dict(row) if row else None
 
 def set_reviewer_decision(aid: int, decision: str):
     conn = get_conn()
     cur = conn.cursor()
     cur.execute("UPDATE audits SET reviewer_decision=? WHERE id=?", (decision, aid))
-    conn.commit()
-    conn.close()
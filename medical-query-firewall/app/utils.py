@@ -1,14 +1,112 @@
 # app/utils.py
+import asyncio
+import logging
+import os
 import re
 import json
 import joblib
+import numpy as np
+from collections import OrderedDict
 from pathlib import Path
 from typing import Dict, Any, List
 
+logger = logging.getLogger(__name__)
+
 # Load rules once
 RULES_PATH = Path("rules/rules.json")
 with open(RULES_PATH, "r", encoding="utf-8") as f:
     RULES = json.load(f)
+_rules_mtime = RULES_PATH.stat().st_mtime  # for get_rules' staleness check
+
+def _is_high_block(rule: Dict[str, Any]) -> bool:
+    return rule["severity"].upper() == "HIGH" and rule["action"].upper() == "BLOCK"
+
+# group names of the form r<number> are reserved for the fused alternation's
+# per-rule groups; a rule pattern defining one would corrupt rule attribution
+_RESERVED_GROUP_RE = re.compile(r"\(\?P<r\d+>")
+
+def _fuse_patterns(rules: List[Dict[str, Any]]):
+    """Fuse rule patterns into one alternation compiled once.
+
+    Each rule becomes a named group r<i>, so a single finditer pass over the
+    input finds every matching rule instead of N separate scans. Compiled with
+    IGNORECASE like the original per-rule patterns: the input is pre-lowered,
+    but admin-uploaded patterns may contain uppercase literals and the flag
+    costs next to nothing at match time.
+    """
+    if not rules:
+        return None
+    return re.compile(
+        "|".join(f"(?P<r{i}>(?:{r['pattern']}))" for i, r in enumerate(rules)),
+        re.IGNORECASE,
+    )
+
+def _compile_rules(rules: List[Dict[str, Any]]):
+    """Partition rules by (HIGH severity, BLOCK action) into two fused regexes.
+
+    The HIGH+BLOCK alternation is checked first on the hot path: a hit
+    decides the request outright, so the remaining rules (and optionally the
+    classifier) are never evaluated.
+    """
+    high = [r for r in rules if _is_high_block(r)]
+    rest = [r for r in rules if not _is_high_block(r)]
+    return (_fuse_patterns(high), high, _fuse_patterns(rest), rest)
+
+HIGH_BLOCK_RE, HIGH_BLOCK_RULES, REST_RE, REST_RULES = _compile_rules(RULES)
+
+def reload_rules(new_rules: List[Dict[str, Any]] = None):
+    """Replace RULES (from disk if new_rules is None) and rebuild compiled patterns.
+
+    Raises ValueError/re.error on a malformed ruleset; in-memory state is only
+    swapped once the new rules validate and compile cleanly.
+    """
+    global RULES, HIGH_BLOCK_RE, HIGH_BLOCK_RULES, REST_RE, REST_RULES, _rules_mtime
+    if new_rules is None:
+        with open(RULES_PATH, "r", encoding="utf-8") as f:
+            new_rules = json.load(f)
+    for i, r in enumerate(new_rules):
+        if not isinstance(r, dict) or not all(k in r for k in ("pattern", "severity", "action")):
+            raise ValueError(f"rule #{i} must be an object with pattern, severity and action")
+        if _RESERVED_GROUP_RE.search(r["pattern"]):
+            raise ValueError(
+                f"rule #{i} pattern uses a reserved group name (r<number>); rename the group")
+    compiled = _compile_rules(new_rules)  # compile first so bad patterns don't clobber state
+    RULES = new_rules
+    HIGH_BLOCK_RE, HIGH_BLOCK_RULES, REST_RE, REST_RULES = compiled
+    _decision_cache.clear()  # cached decisions may predate the new rules
+    try:
+        _rules_mtime = RULES_PATH.stat().st_mtime
+    except OSError:
+        _rules_mtime = None
+
+def save_rules(new_rules: List[Dict[str, Any]]):
+    """Validate and activate new_rules, then persist them to rules.json.
+
+    The file is written only after the rules compile, so a bad upload can
+    never leave a ruleset on disk that the next server start chokes on.
+    """
+    global _rules_mtime
+    reload_rules(new_rules)
+    with open(RULES_PATH, "w", encoding="utf-8") as f:
+        json.dump(new_rules, f, indent=2)
+    try:
+        _rules_mtime = RULES_PATH.stat().st_mtime
+    except OSError:
+        _rules_mtime = None
+
+def get_rules() -> List[Dict[str, Any]]:
+    """Current rules, re-reading rules.json only if its mtime changed."""
+    try:
+        mtime = RULES_PATH.stat().st_mtime
+    except OSError:
+        return RULES
+    if mtime != _rules_mtime:
+        try:
+            reload_rules()
+        except Exception:
+            # out-of-band edit left a broken file; keep serving the last good rules
+            logger.warning("rules.json changed on disk but failed to load; serving previous rules")
+    return RULES
 
 # Load classifier pipeline (tfidf + clf) which must implement predict_proba
 MODEL_PATH = Path("models/classifier.joblib")
@@ -16,48 +114,287 @@ if not MODEL_PATH.exists():
     raise FileNotFoundError(f"Classifier not found at {MODEL_PATH}. Run train_and_eval.py first.")
 clf = joblib.load(MODEL_PATH)
 
-# Simple PII regexes (MVP): email, phone (10 digits), Aadhaar-like (12 digits)
-PII_PATTERNS = {
-    "email": re.compile(r"[a-zA-Z0-9.\-+_]+@[a-zA-Z0-9.\-+_]+\.[a-zA-Z]+"),
-    "phone": re.compile(r"\b\d{10}\b"),
-    "aadhaar": re.compile(r"\b\d{12}\b")
-}
+# Simple PII detection (MVP): email via regex; phone (10 digits) and
+# Aadhaar-like (12 digits) numbers via one linear digit-run scan — counting
+# a run of digits doesn't need a backtracking regex engine.
+EMAIL_RE = re.compile(r"[a-zA-Z0-9.\-+_]+@[a-zA-Z0-9.\-+_]+\.[a-zA-Z]+")
+_DIGIT_RUN_LABELS = {10: "phone", 12: "aadhaar"}
+
+def _is_word_char(c: str) -> bool:
+    return c.isalnum() or c == "_"
+
+def _mask_digit_runs(text: str, pii_found: List[str]) -> str:
+    """Mask maximal digit runs of exactly 10/12 digits (\\b\\d{10}\\b semantics)."""
+    out = []
+    last = 0
+    i = 0
+    n = len(text)
+    while i < n:
+        if text[i].isdigit():
+            j = i
+            while j < n and text[j].isdigit():
+                j += 1
+            label = _DIGIT_RUN_LABELS.get(j - i)
+            # word-boundary check: the run must not abut a letter/underscore
+            if label and (i == 0 or not _is_word_char(text[i - 1])) \
+                    and (j == n or not _is_word_char(text[j])):
+                out.append(text[last:i])
+                out.append(f"[{label.upper()}]")
+                if label not in pii_found:
+                    pii_found.append(label)
+                last = j
+            i = j
+        else:
+            i += 1
+    if not out:
+        return text
+    out.append(text[last:])
+    return "".join(out)
 
 def mask_pii(text: str) -> Dict[str, Any]:
     """Mask detected PII and return masked text + list of pii types."""
     pii_found = []
-    masked = text
-    for name, patt in PII_PATTERNS.items():
-        if patt.search(masked):
-            masked = patt.sub(f"[{name.upper()}]", masked)
-            pii_found.append(name)
+
+    def _email_repl(m):
+        if "email" not in pii_found:
+            pii_found.append("email")
+        return "[EMAIL]"
+
+    masked = EMAIL_RE.sub(_email_repl, text)
+    masked = _mask_digit_runs(masked, pii_found)
     return {"masked_text": masked, "pii": pii_found}
 
-def match_rules(text: str) -> List[Dict[str, Any]]:
-    """Return list of rules that match the input (case-insensitive)."""
-    matches = []
-    for r in RULES:
-        patt = re.compile(r["pattern"], re.IGNORECASE)
-        if patt.search(text):
-            matches.append(r)
-    return matches
+def _scan_rules(regex, rules: List[Dict[str, Any]], text_lower: str) -> List[Dict[str, Any]]:
+    if regex is None:
+        return []
+    # only the generated r<i> groups index into `rules`; named groups inside
+    # a rule's own pattern also show up in groupdict and must be skipped
+    hit = {
+        int(name[1:])
+        for m in regex.finditer(text_lower)
+        for name, val in m.groupdict().items()
+        if val is not None and name[0] == "r" and name[1:].isdigit()
+    }
+    return [rules[i] for i in sorted(hit)]
 
-def classify_text(text: str) -> Dict[str, Any]:
-    """Return predicted label and a risk score (mapped from probabilities)."""
-    proba = clf.predict_proba([text])[0]
-    labels = list(clf.classes_)
+def match_high_block_rules(text: str, text_lower: str = None) -> List[Dict[str, Any]]:
+    """Matching HIGH+BLOCK rules only — the short-circuit set."""
+    if text_lower is None:
+        text_lower = text.lower()
+    return _scan_rules(HIGH_BLOCK_RE, HIGH_BLOCK_RULES, text_lower)
+
+def match_rules(text: str, text_lower: str = None) -> List[Dict[str, Any]]:
+    """Return list of rules that match the input (case-insensitive).
+
+    HIGH+BLOCK rules come first in the result, then the remaining matches.
+    """
+    if text_lower is None:
+        text_lower = text.lower()
+    return (_scan_rules(HIGH_BLOCK_RE, HIGH_BLOCK_RULES, text_lower)
+            + _scan_rules(REST_RE, REST_RULES, text_lower))
+
+# -------------------------
+# Fast predictor
+# -------------------------
+# The pipeline's per-request cost is dominated by TfidfVectorizer's Python
+# tokenization plus sklearn's generic dispatch. The learned parameters are
+# plain arrays, so we pull them out once at load time and reimplement
+# predict_proba as regex tokenize -> vocab lookups -> sparse dot -> softmax.
+# float32 halves the bandwidth of the coefficient matrix; the probability
+# difference vs the pipeline is below 1e-5.
+_VEC = clf.named_steps["tfidf"]
+_LR = clf.named_steps["clf"]
+VOCAB = _VEC.vocabulary_
+IDF = _VEC.idf_.astype(np.float32)
+COEF = _LR.coef_.astype(np.float32)
+INTERCEPT = _LR.intercept_.astype(np.float32)
+CLASSES = list(_LR.classes_)
+TOKEN_RE = re.compile(_VEC.token_pattern)
+NGRAM_MIN, NGRAM_MAX = _VEC.ngram_range
+
+def _tfidf_row(text_lower: str):
+    """Sparse tf-idf row for one lowercased text: (col indices, l2-normed values)."""
+    tokens = TOKEN_RE.findall(text_lower)
+    counts: Dict[int, int] = {}
+    lookup = VOCAB.get
+    for n in range(NGRAM_MIN, NGRAM_MAX + 1):
+        for i in range(len(tokens) - n + 1):
+            idx = lookup(tokens[i] if n == 1 else " ".join(tokens[i:i + n]))
+            if idx is not None:
+                counts[idx] = counts.get(idx, 0) + 1
+    cols = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+    vals = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * IDF[cols]
+    norm = np.sqrt(np.dot(vals, vals))
+    if norm > 0:
+        vals /= norm
+    return cols, vals
+
+# Optional Numba acceleration: the remaining hot spot after extracting the
+# model parameters is the Python tokenize + vocab lookup loop. When numba is
+# installed we JIT that loop (typed dict vocab, dense float32 output row) and
+# warm it at import so the first request doesn't pay the compile cost.
+# Without numba the pure-Python sparse path below is used.
+try:
+    from numba import njit as _njit, types as _nb_types
+    from numba.typed import Dict as _NumbaDict
+except ImportError:
+    _njit = None
+
+_TFIDF_JIT = None
+if _njit is not None and NGRAM_MIN == 1:
+    _NB_VOCAB = _NumbaDict.empty(_nb_types.unicode_type, _nb_types.int32)
+    for _tok, _idx in VOCAB.items():
+        _NB_VOCAB[_tok] = np.int32(_idx)
+
+    @_njit(cache=True)
+    def _tfidf_row_jit(text, vocab, idf, out, ngram_max):
+        """Fill `out` with the l2-normalized tf-idf row for lowercased `text`."""
+        out[:] = np.float32(0.0)
+        n = len(text)
+        tokens = []
+        start = -1
+        # tokens = runs of word chars, length >= 2 (mirrors \b\w\w+\b)
+        for i in range(n):
+            c = text[i]
+            is_word = c.isalnum() or c == "_"
+            if is_word and start < 0:
+                start = i
+            elif not is_word and start >= 0:
+                if i - start >= 2:
+                    tokens.append(text[start:i])
+                start = -1
+        if start >= 0 and n - start >= 2:
+            tokens.append(text[start:n])
+        m = len(tokens)
+        for i in range(m):
+            gram = tokens[i]
+            for k in range(ngram_max):
+                if k > 0:
+                    if i + k >= m:
+                        break
+                    gram = gram + " " + tokens[i + k]
+                if gram in vocab:
+                    out[vocab[gram]] += np.float32(1.0)
+        for j in range(out.shape[0]):
+            out[j] *= idf[j]
+        norm = np.float32(0.0)
+        for j in range(out.shape[0]):
+            norm += out[j] * out[j]
+        norm = np.sqrt(norm)
+        if norm > 0:
+            for j in range(out.shape[0]):
+                out[j] /= norm
+
+    _tfidf_row_jit("warm up", _NB_VOCAB, IDF, np.zeros_like(IDF), NGRAM_MAX)
+    _TFIDF_JIT = _tfidf_row_jit
+
+def predict_proba_fast(text: str) -> np.ndarray:
+    """predict_proba for one text without touching the sklearn pipeline."""
+    text_lower = text.lower()
+    if _TFIDF_JIT is not None:
+        row = np.empty_like(IDF)
+        _TFIDF_JIT(text_lower, _NB_VOCAB, IDF, row, NGRAM_MAX)
+        scores = COEF @ row + INTERCEPT
+    else:
+        cols, vals = _tfidf_row(text_lower)
+        scores = COEF[:, cols] @ vals + INTERCEPT
+    scores -= scores.max()
+    e = np.exp(scores)
+    return e / e.sum()
+
+def predict_proba_fast_batch(texts: List[str]) -> np.ndarray:
+    """predict_proba for several texts: stacked tf-idf rows, one matmul.
+
+    This is what makes the micro-batcher worthwhile — N queued texts cost
+    one COEF multiply instead of N."""
+    X = np.empty((len(texts), IDF.shape[0]), dtype=np.float32)
+    for i, text in enumerate(texts):
+        text_lower = text.lower()
+        if _TFIDF_JIT is not None:
+            _TFIDF_JIT(text_lower, _NB_VOCAB, IDF, X[i], NGRAM_MAX)
+        else:
+            X[i] = 0.0
+            cols, vals = _tfidf_row(text_lower)
+            X[i, cols] = vals
+    scores = X @ COEF.T + INTERCEPT
+    scores -= scores.max(axis=1, keepdims=True)
+    e = np.exp(scores)
+    return e / e.sum(axis=1, keepdims=True)
+
+def _proba_to_result(proba) -> Dict[str, Any]:
+    """Map one row of predict_proba output to the classify_text result dict."""
     top_idx = int(proba.argmax())
-    label = labels[top_idx]
+    label = CLASSES[top_idx]
     score = float(proba[top_idx])
-    proba_dict = dict(zip(labels, map(float, proba)))
+    proba_dict = dict(zip(CLASSES, map(float, proba)))
     return {"label": label, "score": score, "proba": proba_dict}
 
+def classify_text(text: str) -> Dict[str, Any]:
+    """Return predicted label and a risk score (mapped from probabilities)."""
+    return _proba_to_result(predict_proba_fast(text))
+
+# -------------------------
+# Classifier micro-batching
+# -------------------------
+# predict_proba on a batch-of-one wastes most of the TF-IDF/matmul cost.
+# Concurrent requests park a future on a queue; a single background task
+# coalesces everything already queued (up to CLASSIFY_BATCH_MAX) into one
+# predict_proba_fast_batch call and fans the rows back out. The drain is
+# get_nowait only — a lone request is never delayed waiting for company;
+# batches simply form whenever concurrent handlers enqueue before the
+# batcher task gets scheduled.
+CLASSIFY_BATCH_MAX = 16
+
+_classify_queue = None  # created by start_classifier_batcher
+
+def start_classifier_batcher() -> "asyncio.Task":
+    """Create the batching queue + task; call from the app startup hook."""
+    global _classify_queue
+    _classify_queue = asyncio.Queue()
+    return asyncio.create_task(_classifier_batcher())
+
+def stop_classifier_batcher():
+    global _classify_queue
+    _classify_queue = None
+
+async def _classifier_batcher():
+    while True:
+        pending = [await _classify_queue.get()]
+        while len(pending) < CLASSIFY_BATCH_MAX:
+            try:
+                pending.append(_classify_queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            probas = predict_proba_fast_batch([t for t, _ in pending])
+        except Exception as e:
+            for _, fut in pending:
+                if not fut.done():
+                    fut.set_exception(e)
+            continue
+        for (_, fut), proba in zip(pending, probas):
+            if not fut.done():
+                fut.set_result(proba)
+
+async def classify_text_async(text: str) -> Dict[str, Any]:
+    """Batched classify_text. Falls back to the sync path if no batcher runs."""
+    if _classify_queue is None:
+        return classify_text(text)
+    fut = asyncio.get_running_loop().create_future()
+    _classify_queue.put_nowait((text, fut))
+    return _proba_to_result(await fut)
+
 # -------------------------
 # Class-specific thresholds
 # -------------------------
 # Block thresholds: if probability for this class >= value => immediate BLOCK (if not overridden by rule)
 # Warn thresholds: if probability >= warn but < block => WARN
 # Tune these thresholds based on eval_report.json (precision/recall tradeoff)
+# A HIGH+BLOCK rule decides the outcome on its own; running the classifier
+# there is purely for explainability. Set INCLUDE_CLASSIFIER_ON_RULE_BLOCK=0
+# to skip that inference (explain shows classifier: null instead).
+INCLUDE_CLASSIFIER_ON_RULE_BLOCK = os.environ.get("INCLUDE_CLASSIFIER_ON_RULE_BLOCK", "1") != "0"
+
 CLASS_THRESHOLDS = {
     "self_harm": 0.40,            # lower blockade for self-harm (safety-critical)
     "prescription_request": 0.60,
@@ -69,7 +406,26 @@ WARN_THRESHOLDS = {
     "procedural": 0.35
 }
 
-def decision_aggregator(text: str) -> Dict[str, Any]:
+# Repeat queries are common (demo probes, retries), so completed decisions
+# are cached keyed on the masked text. lru_cache doesn't compose with async
+# functions, hence the small hand-rolled LRU. Audit logging stays in the
+# endpoint, outside the cache, so every request is still recorded.
+DECISION_CACHE_MAX = 4096
+_decision_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+
+async def decision_aggregator(text: str, text_lower: str = None) -> Dict[str, Any]:
+    """Cached wrapper around _decide; see _decide for the decision logic."""
+    cached = _decision_cache.get(text)
+    if cached is not None:
+        _decision_cache.move_to_end(text)
+        return cached
+    result = await _decide(text, text_lower if text_lower is not None else text.lower())
+    _decision_cache[text] = result
+    if len(_decision_cache) > DECISION_CACHE_MAX:
+        _decision_cache.popitem(last=False)
+    return result
+
+async def _decide(text: str, text_lower: str) -> Dict[str, Any]:
     """
     Combines rules + classifier probabilities -> decision.
     Priority order:
@@ -83,14 +439,21 @@ def decision_aggregator(text: str) -> Dict[str, Any]:
          - Else -> ALLOW
     Returns dict with 'decision', 'matched_rules', and 'classifier' (with proba dict).
     """
-    # 1) Rule matching (rules always have highest priority)
-    r_matches = match_rules(text)
-    if any(r["severity"].upper() == "HIGH" and r["action"].upper() == "BLOCK" for r in r_matches):
-        clf_res = classify_text(text)  # include classifier info for explainability
-        return {"decision": "BLOCK", "matched_rules": r_matches, "classifier": clf_res}
+    # 1) HIGH+BLOCK rules (always highest priority): checked on their own
+    # fused regex first, so a hit skips the remaining rule scan and — when
+    # the explainability inference is disabled — the classifier entirely.
+    high_matches = match_high_block_rules(text, text_lower)
+    if high_matches:
+        if not INCLUDE_CLASSIFIER_ON_RULE_BLOCK:
+            return {"decision": "BLOCK", "matched_rules": high_matches, "classifier": None}
+        # classifier info only for explainability here
+        clf_res = await classify_text_async(text_lower)
+        return {"decision": "BLOCK", "matched_rules": high_matches, "classifier": clf_res}
+
+    r_matches = _scan_rules(REST_RE, REST_RULES, text_lower)
 
     # 2) Classifier probabilities
-    clf_res = classify_text(text)
+    clf_res = await classify_text_async(text_lower)
     proba = clf_res.get("proba", {})
     # Evaluate hazardous classes
     block_hits = []
@@ -125,9 +488,14 @@ KB = {
     "What is a normal blood pressure?": "Normal blood pressure is around 120/80 mmHg, but targets depend on age and comorbidities."
 }
 
-def pass_through_llm(text: str) -> str:
+# one alternation over the lowercased KB keys: a single scan of the
+# pre-lowercased text replaces per-key lower() + substring searches
+KB_KEYS = list(KB)
+KB_RE = re.compile("|".join(f"(?P<k{i}>{re.escape(k.lower())})" for i, k in enumerate(KB_KEYS)))
+
+def pass_through_llm(text: str, text_lower: str = None) -> str:
     """Return helpful general answer. In real system, call sanitized LLM API here."""
-    for k in KB:
-        if k.lower() in text.lower():
-            return KB[k]
+    m = KB_RE.search(text_lower if text_lower is not None else text.lower())
+    if m:
+        return KB[KB_KEYS[int(m.lastgroup[1:])]]
     return "I can provide general medical information, but not personalized prescriptions. Consult a licensed provider for treatment decisions."
@@ -13,12 +13,15 @@ send.onclick = async () => {
   const text = msg.value.trim();
   if (!text) return;
   appendLine(`<b>You:</b> ${text}`);
-  const resp = await fetch("/api/chat", {
+  const resp = await fetch("/api/chat?debug=1", {
     method: "POST",
     headers: {"Content-Type":"application/json"},
     body: JSON.stringify({text})
   });
   const j = await resp.json();
+  if (j.explain && j.explain.classifier === null) {
+    j.explain.classifier = "skipped (rule blocked)";
+  }
   if (j.decision === "BLOCK") {
     appendLine(`<b class="block">Decision: BLOCK</b><div>${j.safe_response}</div><pre>${JSON.stringify(j.explain, null, 2)}</pre>`);
   } else if (j.decision === "WARN") {
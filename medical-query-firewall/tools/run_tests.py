@@ -11,11 +11,13 @@ cases = [
 ]
 out = []
 for text, label in cases:
-    r = requests.post("http://127.0.0.1:8000/api/chat", json={"text": text})
+    # debug=1: BLOCK responses only carry explain/classifier when asked
+    r = requests.post("http://127.0.0.1:8000/api/chat?debug=1", json={"text": text})
     j = r.json()
     explain = j.get("explain", {})
-    pred = explain.get("classifier", {}).get("label")
-    proba = explain.get("classifier", {}).get("proba")
+    classifier = explain.get("classifier") or {}  # null when skipped on rule block
+    pred = classifier.get("label")
+    proba = classifier.get("proba")
     decision = j.get("decision", j.get("decision","UNKNOWN"))
     out.append([text, label, pred, decision, json.dumps(proba)])
 with open("test_results.csv","w",newline="",encoding="utf-8") as f: